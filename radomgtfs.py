@@ -1,16 +1,23 @@
 from urllib.parse import urljoin
-from email.utils import parsedate_to_datetime
+from email.utils import formatdate, parsedate_to_datetime
 from datetime import datetime, date, timedelta
 from warnings import warn
 from tzlocal import get_localzone
-from typing import Tuple, List, Dict, Set, Optional
-from bs4 import BeautifulSoup
+from typing import Iterable, Iterator, Tuple, List, Dict, Set, Optional
+from contextlib import contextmanager
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from operator import itemgetter
 import subprocess
 import requests
 import argparse
 import zipfile
+import tempfile
 import shutil
-import shlex
+import html
 import zeep
 import time
 import csv
@@ -31,23 +38,63 @@ KNOWN_SERVICES = {"POWSZEDNI", "SOBOTA", "NIEDZIELA"}
 IGNORE_STOPS = {1220, 1221, 1222, 1223, 1224, 1225, 1226, 1227, 1228, 1229,
                 649, 652, 653, 659, 662}
 
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Formatted times, indexed by minutes after midnight (up to 48:00)
+GTFS_TIMES = ["{:0>2}:{:0>2}:00".format(*divmod(i, 60)) for i in range(48 * 60)]
+TRIP_ID_TIMES = ["{:0>2}{:0>2}".format(*divmod(i, 60)) for i in range(48 * 60)]
+
+HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+ANCHOR_HREF_RE = re.compile(
+    r"""<a\b[^>]*?\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""",
+    re.IGNORECASE,
+)
+SCHEDULE_HREF_RE = re.compile(r"/upload/file/Rozklady.+\.zip")
+SCHEDULE_VERSION_RE = re.compile(r"[0-9-]+")
+ROUTE_DIRECTION_RE = re.compile(
+    r"""<td\b[^>]*\bcolspan=["']?3\b["']?[^>]*>(?:(?!</td>).)*?<b\b[^>]*>([^<]*)</b>""",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Shared between all HTTP calls, so that connections to the same host are kept alive
+SESSION = requests.Session()
+SESSION_ADAPTER = HTTPAdapter(pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.3))
+SESSION.mount("http://", SESSION_ADAPTER)
+SESSION.mount("https://", SESSION_ADAPTER)
+
 # HELPER FUNCTIONS #
 
 
-def dump_mdb_table(mdb_file: str, table_name: str) -> Tuple[io.StringIO, csv.DictReader]:
-    result = subprocess.run(
-        shlex.join(["mdb-export", mdb_file, table_name]),
+@contextmanager
+def dump_mdb_table(
+        mdb_file: str,
+        table_name: str) -> Iterator[Tuple[Dict[str, int], Iterator[List[str]]]]:
+    """Streams rows of an MDB table straight from mdb-export's stdout.
+    Yields a mapping of column names to row indices and an iterator over the rows."""
+    proc = subprocess.Popen(
+        ["mdb-export", mdb_file, table_name],
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        env={"MDB_JET3_CHARSET": "CP1250"},
+        stderr=None,
+        env={"PATH": os.environ.get("PATH", os.defpath), "MDB_JET3_CHARSET": "CP1250"},
         encoding="utf-8",
-        shell=True
+        bufsize=1024 * 1024,
     )
 
-    result.check_returncode()
-    buffer = io.StringIO(result.stdout, newline="")
-    reader = csv.DictReader(buffer)
-    return buffer, reader
+    try:
+        reader = csv.reader(proc.stdout)
+        header = next(reader, None)
+
+        # No header row means mdb-export failed (e.g. missing table or unreadable file)
+        if header is None:
+            raise subprocess.CalledProcessError(proc.wait(), proc.args)
+
+        yield {name: idx for idx, name in enumerate(header)}, reader
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, proc.args)
 
 
 def clear_directory(directory):
@@ -61,14 +108,18 @@ def clear_directory(directory):
         os.mkdir(directory)
 
 
+@lru_cache(maxsize=None)
 def route_name(short_name: str) -> str:
     short_name = short_name.rjust(4, "0")
 
-    website = requests.get(f"http://www.mzdik.pl/rozklady/{short_name.lower()}/w.htm")
+    website = SESSION.get(f"http://www.mzdik.pl/rozklady/{short_name.lower()}/w.htm")
     website.encoding = "latin2"
-    soup = BeautifulSoup(website.text, "html.parser")
 
-    dirs = list(map(lambda i: i.find("b").string, soup.find_all("td", colspan="3")))
+    # Direction names are the first bold text in <td colspan="3"> cells
+    dirs = [html.unescape(i) for i in ROUTE_DIRECTION_RE.findall(website.text)]
+
+    if len(dirs) == 0:
+        warn(f"no direction names found on timetable page of route {short_name!r}")
 
     # We only need 2 direction names to create route_long_name
     del dirs[2:]
@@ -81,14 +132,22 @@ def route_name(short_name: str) -> str:
 
 
 def gtfs_time(minutes_after_midnight: int) -> str:
+    if 0 <= minutes_after_midnight < len(GTFS_TIMES):
+        return GTFS_TIMES[minutes_after_midnight]
     return "{:0>2}:{:0>2}:00".format(*divmod(minutes_after_midnight, 60))
 
 
+def trip_id_time(minutes_after_midnight: int) -> str:
+    if 0 <= minutes_after_midnight < len(TRIP_ID_TIMES):
+        return TRIP_ID_TIMES[minutes_after_midnight]
+    return "{:0>2}{:0>2}".format(*divmod(minutes_after_midnight, 60))
+
+
 def calendar_exceptions() -> Dict[date, str]:
     print("\033[1A\033[K" "Downloading calendar exceptions")
 
-    req = requests.get("https://docs.google.com/spreadsheets/d/"
-                       "1kSCBQyIE8bz2NgqpzyS75I7ndnlp4dhD3TmEY2jO7K0/export?format=csv")
+    req = SESSION.get("https://docs.google.com/spreadsheets/d/"
+                      "1kSCBQyIE8bz2NgqpzyS75I7ndnlp4dhD3TmEY2jO7K0/export?format=csv")
     req.encoding = "utf8"
     req.raise_for_status()
 
@@ -109,7 +168,8 @@ def calendar_exceptions() -> Dict[date, str]:
 
 
 def compress(target):
-    with zipfile.ZipFile(target, mode="w", compression=zipfile.ZIP_DEFLATED) as arch:
+    with zipfile.ZipFile(target, mode="w", compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=1) as arch:
         for f in os.scandir("gtfs"):
             if f.name.endswith(".txt"):
                 arch.write(f.path, arcname=f.name)
@@ -118,25 +178,27 @@ def compress(target):
 # DATA DOWNLOADING #
 
 def list_files() -> List[dict]:
-    website = requests.get("http://www.mzdik.radom.pl/index.php?id=145")
-    soup = BeautifulSoup(website.text, "html.parser")
-    anchors = soup.find_all("a", href=re.compile(r"/upload/file/Rozklady.+\.zip"))
+    website = SESSION.get("http://www.mzdik.radom.pl/index.php?id=145")
+    page = HTML_COMMENT_RE.sub("", website.text)
+
+    # Only one of the groups (double-quoted, single-quoted, unquoted) is ever non-empty
+    hrefs = [html.unescape("".join(i)) for i in ANCHOR_HREF_RE.findall(page)]
+    hrefs = [i for i in hrefs if SCHEDULE_HREF_RE.search(i)]
     files = []
 
-    if len(anchors) == 0:
+    if len(hrefs) == 0:
         raise RuntimeError("Schedules file not found on http://mzdik.radom.pl/?id=145")
 
-    for anchor in anchors:
-        href = anchor.get("href")
+    for href in hrefs:
         link = urljoin("http://www.mzdik.radom.pl/index.php?id=145", href)
-        version = re.search(r"[0-9-]+", href)
+        version = SCHEDULE_VERSION_RE.search(href)
 
         if not version:
             raise ValueError(f"unable to get feed_version from href {href!r}")
         else:
             version = version[0].lstrip("-")
 
-        start_date = datetime.strptime(version, "%Y-%m-%d").date()
+        start_date = date.fromisoformat(version)
 
         files.append({
             "url": link,
@@ -158,64 +220,87 @@ def list_files() -> List[dict]:
 
 
 def unpack_zip(req, target, version):
-    zip_stream = io.BytesIO(req.content)
+    # Spool the archive to disk once it gets large, instead of keeping it all in memory
+    with tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024) as zip_stream:
+        req.raw.decode_content = True
+        shutil.copyfileobj(req.raw, zip_stream)
+        zip_stream.seek(0)
 
-    with zipfile.ZipFile(zip_stream) as arch:
+        with zipfile.ZipFile(zip_stream) as arch:
 
-        zip_files = arch.namelist()
-        if len(zip_files) == 1:
-            dbase_name = zip_files[0]
-        else:
-            raise ValueError(f"zipfile corresponding to version {version} "
-                             f"has more then one file inside: {zip_files}")
+            zip_files = arch.namelist()
+            if len(zip_files) == 1:
+                dbase_name = zip_files[0]
+            else:
+                raise ValueError(f"zipfile corresponding to version {version} "
+                                 f"has more then one file inside: {zip_files}")
+
+            # Databases inside different archives may share the same name,
+            # and archives are unpacked concurrently - so extract to a per-version temporary file,
+            # and only replace the target once the whole database was extracted
+            temp_target = target + ".part"
 
-        arch.extract(dbase_name, path="db")
-        os.rename(os.path.join("db", dbase_name), target)
+            try:
+                with arch.open(dbase_name) as src, open(temp_target, mode="wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            except BaseException:
+                if os.path.exists(temp_target):
+                    os.remove(temp_target)
+                raise
+
+            os.replace(temp_target, target)
 
 
 def get_files(files) -> bool:
     os.makedirs("db", exist_ok=True)
     things_changed = False
-
-    def is_in_files(version):
-        for i in files:
-            if i["version"] == version:
-                return True
-        return False
+    wanted_versions = {i["version"] for i in files}
 
     # Remove unwanted files
     for f in os.scandir("db"):
-        f_ver = f.name.rstrip(".mdb")
+        f_ver = f.name[:-4] if f.name.endswith(".mdb") else f.name
 
-        if not is_in_files(f_ver):
+        if f_ver not in wanted_versions:
             os.remove(f.path)
             things_changed = True
 
-    # Download missing databases
-    for file_info in files:
-
+    def sync_file(file_info) -> bool:
         try:
             local_modtime = os.stat(file_info["path"]).st_mtime
         except FileNotFoundError:
             local_modtime = 0
 
-        # Turn the timestamp into an aware datetime object
-        local_modtime = datetime.fromtimestamp(local_modtime, tz=get_localzone())
+        # Make a conditional request for the file, so that the server can skip unchanged ones
+        headers = {}
+        if local_modtime:
+            headers["If-Modified-Since"] = formatdate(local_modtime, usegmt=True)
 
-        # Make a request for the file
-        req = requests.get(file_info["url"], stream=True)
+        req = SESSION.get(file_info["url"], headers=headers, stream=True)
         req.raise_for_status()
 
+        if req.status_code == 304:
+            req.close()
+            return False
+
+        # Turn the timestamp into an aware datetime object
+        local_modtime = datetime.fromtimestamp(local_modtime, tz=get_localzone())
+
+        # Servers may ignore If-Modified-Since, so compare the timestamps anyway
         remote_modtime = parsedate_to_datetime(req.headers["Last-Modified"])
 
         # The uploaded file is newer, redownload it
-        if remote_modtime > local_modtime:
-            things_changed = True
+        downloaded = remote_modtime > local_modtime
+        if downloaded:
             unpack_zip(req, file_info["path"], file_info["version"])
 
         req.close()
+        return downloaded
+
+    # Download missing databases
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        downloaded = list(executor.map(sync_file, files))
 
-    return things_changed
+    return things_changed or any(downloaded)
 
 
 # DATA PARSING #
@@ -260,49 +345,22 @@ class StopHandler:
             raise RuntimeError("no stops returned from rkm.mzdik.radom.pl")
 
         for stop in stops:
-
-            stop_id = int(stop.get("id"))
+            attrs = stop.attrib
+            stop_id = int(attrs["id"])
 
             if stop_id in IGNORE_STOPS:
                 continue
 
             self.data[stop_id] = {  # type: ignore
                 "stop_id": stop_id,
-                "stop_name": stop.get("n").strip(),
-                "stop_lat": stop.get("y"),
-                "stop_lon": stop.get("x"),
+                "stop_name": attrs["n"].strip(),
+                "stop_lat": attrs.get("y", ""),
+                "stop_lon": attrs.get("x", ""),
             }
 
-    def read_table(self, mdb_file):
-        # Open database dump
-        buff, reader = dump_mdb_table(mdb_file, "tStakes")
-
-        # Load stops
-        for stop in reader:
-            stop_id = int(stop["ID"])
-
-            # Invalid Stop
-            if stop_id not in self.data:
-                self.invalid[stop_id] = stop["nSymbol"], stop["nName"]
-
-        buff.close()
-
-    def check_id(self, stop_id: int) -> bool:
-        """Check if this stop_id can be outputed to stop_times.txt"""
-
-        if stop_id in IGNORE_STOPS:
-            return False
-
-        elif stop_id in self.data:
-            return True
-
-        else:
-            self.used_missing.add(stop_id)
-            return False
-
-    def use_id(self, stop_id: int):
-        """Mark this stop_id as used"""
-        self.used.add(stop_id)
+    def use_ids(self, stop_ids: Iterable[int]):
+        """Mark all of those stop_ids as used"""
+        self.used.update(stop_ids)
 
     def export(self):
         """Save all used stops to stops.txt and
@@ -327,24 +385,136 @@ class StopHandler:
                 wrtr.writerow([used_invalid_stop, stop_code, stop_name])
 
 
+class DatabaseParser:
+    """Loads trips and their stop_times from a single MDB file.
+
+    Instances only hold plain, picklable data,
+    so that databases can be parsed in separate worker processes.
+    """
+
+    def __init__(self, mdb_file: str, known_stops: Set[int]):
+        self.mdb_file = mdb_file
+        self.known_stops = known_stops
+
+        self.invalid_stops: Dict[int, Tuple[str, str]] = {}
+        self.used_missing_stops: Set[int] = set()
+
+        self.daytype_to_service: Dict[int, str] = {}
+        self.pattern_to_route: Dict[int, str] = {}
+        self.trips: Dict[int, dict] = {}
+
+    @classmethod
+    def parse(cls, mdb_file: str, known_stops: Set[int]) -> "DatabaseParser":
+        self = cls(mdb_file, known_stops)
+        self.read_stops()
+        self.map_patterns()
+        self.map_services()
+        self.load_trips()
+        self.load_times()
+        return self
+
+    def read_stops(self):
+        with dump_mdb_table(self.mdb_file, "tStakes") as (columns, reader):
+            i_id, i_symbol, i_name = columns["ID"], columns["nSymbol"], columns["nName"]
+
+            for stop in reader:
+                stop_id = int(stop[i_id])
+
+                # Invalid Stop
+                if stop_id not in self.known_stops:
+                    self.invalid_stops[stop_id] = stop[i_symbol], stop[i_name]
+
+    def check_stop(self, stop_id: int) -> bool:
+        """Check if this stop_id can be outputed to stop_times.txt"""
+
+        if stop_id in IGNORE_STOPS:
+            return False
+
+        elif stop_id in self.known_stops:
+            return True
+
+        else:
+            self.used_missing_stops.add(stop_id)
+            return False
+
+    def map_patterns(self):
+        # Map database route IDs to GTFS route_id.
+        with dump_mdb_table(self.mdb_file, "tLines") as (columns, reader):
+            i_id, i_number = columns["ID"], columns["nNumber"]
+            convert_route_id = {i[i_id]: i[i_number] for i in reader}
+
+        # Map nDir → route_id
+        with dump_mdb_table(self.mdb_file, "tDirs") as (columns, reader):
+            i_id, i_line = columns["ID"], columns["nLine"]
+
+            for pattern in reader:
+                self.pattern_to_route[int(pattern[i_id])] = convert_route_id[pattern[i_line]]
+
+    def map_services(self):
+        with dump_mdb_table(self.mdb_file, "tDayTypes") as (columns, reader):
+            i_id, i_name = columns["ID"], columns["nName"]
+            self.daytype_to_service = {int(i[i_id]): i[i_name].upper().strip() for i in reader}
+
+    def load_trips(self):
+        with dump_mdb_table(self.mdb_file, "tDepts") as (columns, reader):
+            i_id, i_dir, i_daytype, i_time, i_team = (
+                columns["ID"], columns["nDir"], columns["nDayType"], columns["nTime"],
+                columns["nTeam"],
+            )
+
+            for db_trip in reader:
+                route_id = self.pattern_to_route[int(db_trip[i_dir])]
+                service_id = self.daytype_to_service[int(db_trip[i_daytype])]
+                start_time = trip_id_time(int(db_trip[i_time]))
+
+                trip_id = "-".join([route_id, service_id, db_trip[i_dir], start_time])
+
+                self.trips[int(db_trip[i_id])] = {
+                    "_times": [],
+                    "route_id": route_id,
+                    "service_id": service_id,
+                    "trip_id": trip_id,
+                    "trip_headsign": "",
+                    "team_id": db_trip[i_team],
+                }
+
+    def load_times(self):
+        with dump_mdb_table(self.mdb_file, "tPassages") as (columns, reader):
+            get_fields = itemgetter(columns["nDept"], columns["nTime"], columns["nStake"],
+                                    columns["nOrder"])
+
+            for db_dep in reader:
+                trip_lookup_id, time, stop, stop_sequence = map(int, get_fields(db_dep))
+
+                if self.check_stop(stop):
+                    # Tuples sort by stop_sequence
+                    self.trips[trip_lookup_id]["_times"].append(
+                        (stop_sequence, stop, gtfs_time(time))
+                    )
+
+
 class RadomGtfs:
     def __init__(self):
         # normal attributes
         self.stops = StopHandler()
+        self.stop_names: Dict[int, str] = {}
         self.routes_used = set()
         self.cal_exceptions = calendar_exceptions()
 
+        # (date_str, service_id) for every day, starting from calendar_start
+        self.calendar_start = date.today()
+        self.calendar: List[Tuple[str, str]] = []
+
         # attributes changing per input file
         self.start_date = date.today()
         self.end_date = self.start_date + timedelta(days=SCHEDULE_LENGTH_DAYS)
 
         self.services_used = set()
+        self.services_active = set()
 
         self.id_prefix = ""
         self.mdb_file = ""
 
-        self.daytype_to_service = {}
-        self.pattern_to_route = {}
         self.trips = {}
 
         # files that are written to multiple times
@@ -362,15 +532,19 @@ class RadomGtfs:
         self.dates_wrtr = None
 
     def open_files(self):
-        self.trips_buff = open("gtfs/trips.txt", mode="w", encoding="utf-8", newline="")
-        self.trips_wrtr = csv.DictWriter(self.trips_buff, self.trips_head)
-        self.trips_wrtr.writeheader()
-
-        self.times_buff = open("gtfs/stop_times.txt", mode="w", encoding="utf-8", newline="")
-        self.times_wrtr = csv.DictWriter(self.times_buff, self.times_head)
-        self.times_wrtr.writeheader()
-
-        self.dates_buff = open("gtfs/calendar_dates.txt", mode="w", encoding="utf-8", newline="")
+        # Those files get a large number of small writes, so give them bigger buffers
+        self.trips_buff = open("gtfs/trips.txt", mode="w", encoding="utf-8", newline="",
+                               buffering=WRITE_BUFFER_SIZE)
+        self.trips_wrtr = csv.writer(self.trips_buff)
+        self.trips_wrtr.writerow(self.trips_head)
+
+        self.times_buff = open("gtfs/stop_times.txt", mode="w", encoding="utf-8", newline="",
+                               buffering=WRITE_BUFFER_SIZE)
+        self.times_wrtr = csv.writer(self.times_buff)
+        self.times_wrtr.writerow(self.times_head)
+
+        self.dates_buff = open("gtfs/calendar_dates.txt", mode="w", encoding="utf-8", newline="",
+                               buffering=WRITE_BUFFER_SIZE)
         self.dates_wrtr = csv.writer(self.dates_buff)
         self.dates_wrtr.writerow(self.dates_head)
 
@@ -409,67 +583,43 @@ class RadomGtfs:
             wrtr.writerow(["agency_id", "route_id", "route_short_name", "route_long_name",
                            "route_type", "route_color", "route_text_color"])
 
-            for route_id in sorted(self.routes_used, key=lambda i: i.rjust(4, "0")):
-                long_name = route_name(route_id)
-                wrtr.writerow(["0", route_id, route_id, long_name, "3", "E31E24", "FFFFFF"])
-
-    def verify_services(self):
-        valid_services = set()
-        remove_trips = set()
-
-        # Read used services
-        with open("gtfs/calendar_dates.txt", mode="r", encoding="utf-8", newline="") as f:
-            valid_services = {i["service_id"] for i in csv.DictReader(f)}
-
-        # Verify trips
-        os.rename("gtfs/trips.txt", "gtfs/trips.txt.old")
-        with open("gtfs/trips.txt.old", mode="r", encoding="utf-8", newline="") as in_f, \
-                open("gtfs/trips.txt", mode="w", encoding="utf-8", newline="") as out_f:
-
-            # Create csv writers and readers
-            in_r = csv.DictReader(in_f)
-
-            out_w = csv.DictWriter(out_f, self.trips_head)
-            out_w.writeheader()
+            route_ids = sorted(self.routes_used, key=lambda i: i.rjust(4, "0"))
 
-            for row in in_r:
-                # If trip is in valid_services just re-write it
-                if row["service_id"] in valid_services:
-                    out_w.writerow(row)
+            # Every route_name call is a separate HTTP request, so run them concurrently
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                long_names = executor.map(route_name, route_ids)
 
-                # Otherwise mark trip_id to be removed
-                else:
-                    remove_trips.add(row["trip_id"])
-
-        os.remove("gtfs/trips.txt.old")
+            for route_id, long_name in zip(route_ids, long_names):
+                wrtr.writerow(["0", route_id, route_id, long_name, "3", "E31E24", "FFFFFF"])
 
-        # Verify stop_times
-        os.rename("gtfs/stop_times.txt", "gtfs/stop_times.txt.old")
-        with open("gtfs/stop_times.txt.old", mode="r", encoding="utf-8", newline="") as in_f, \
-                open("gtfs/stop_times.txt", mode="w", encoding="utf-8", newline="") as out_f:
+    def map_calendar(self, start_date: date, end_date: date):
+        """Resolve which service operates on every day from start_date to end_date"""
+        self.calendar_start = start_date
+        self.calendar = []
 
-            # Create csv writers and readers
-            in_r = csv.DictReader(in_f)
+        current_day = start_date
 
-            out_w = csv.DictWriter(out_f, self.times_head)
-            out_w.writeheader()
+        while current_day <= end_date:
+            # Holidays & Sundays
+            if current_day.weekday() == 6 or self.cal_exceptions.get(current_day) == "holiday":
+                service_id = "NIEDZIELA"
 
-            for row in in_r:
-                # If trip is marked to be removed, move to next row
-                if row["trip_id"] in remove_trips:
-                    pass
+            # Saturdays
+            elif current_day.weekday() == 5:
+                service_id = "SOBOTA"
 
-                # Otherwise re-write row
-                else:
-                    out_w.writerow(row)
+            # Workdays
+            else:
+                service_id = "POWSZEDNI"
 
-        os.remove("gtfs/stop_times.txt.old")
+            self.calendar.append((current_day.strftime("%Y%m%d"), service_id))
+            current_day += timedelta(days=1)
 
     # Functions executed for each database
 
     def new_file(
             self,
-            file_name: str,
+            db: DatabaseParser,
             id_prefix: str = "",
             start_date: Optional[date] = None,
             end_date: Optional[date] = None):
@@ -477,83 +627,33 @@ class RadomGtfs:
         self.start_date = start_date or date.today()
         self.end_date = end_date or self.start_date + timedelta(days=SCHEDULE_LENGTH_DAYS)
 
-        self.services_used = set()
-
         self.id_prefix = id_prefix
-        self.mdb_file = file_name
-
-        self.daytype_to_service = {}
-        self.pattern_to_route = {}
-        self.trips = {}
-
-    def map_patterns(self):
-        # Map database route IDs to GTFS route_id.
-        buff, reader = dump_mdb_table(self.mdb_file, "tLines")
-        convert_route_id = {i["ID"]: i["nNumber"] for i in reader}
-        buff.close()
-
-        # Map nDir → route_id
-        buff, reader = dump_mdb_table(self.mdb_file, "tDirs")
-
-        for pattern in reader:
-            self.pattern_to_route[int(pattern["ID"])] = convert_route_id[pattern["nLine"]]
-        buff.close()
+        self.mdb_file = db.mdb_file
 
-    def map_services(self):
-        buff, reader = dump_mdb_table(self.mdb_file, "tDayTypes")
-        self.daytype_to_service = {int(i["ID"]): i["nName"].upper().strip() for i in reader}
-        buff.close()
-
-    def load_trips(self):
-        buff, reader = dump_mdb_table(self.mdb_file, "tDepts")
-
-        for db_trip in reader:
-            route_id = self.pattern_to_route[int(db_trip["nDir"])]
-            service_id = self.daytype_to_service[int(db_trip["nDayType"])]
-            start_time = "{:0>2}{:0>2}".format(*divmod(int(db_trip["nTime"]), 60))
-
-            trip_id = "-".join([route_id, service_id, db_trip["nDir"], start_time])
-
-            self.trips[int(db_trip["ID"])] = {
-                "_times": [],
-                "route_id": route_id,
-                "service_id": service_id,
-                "trip_id": trip_id,
-                "trip_headsign": "",
-                "team_id": db_trip["nTeam"],
-            }
-
-        buff.close()
-
-    def load_times(self):
-        buff, reader = dump_mdb_table(self.mdb_file, "tPassages")
+        self.trips = db.trips
 
-        for db_dep in reader:
-            trip_lookup_id = int(db_dep["nDept"])
-            time = "{:0>2}:{:0>2}:00".format(*divmod(int(db_dep["nTime"]), 60))
-            stop = int(db_dep["nStake"])
+        # Services of trips which will be exported (see export_times)
+        self.services_used = {i["service_id"] for i in self.trips.values()
+                              if len(i["_times"]) >= 2}
+        self.services_active = set()
 
-            if self.stops.check_id(stop):
-
-                self.trips[trip_lookup_id]["_times"].append({
-                    "arrival_time": time,
-                    "departure_time": time,
-                    "stop_id": stop,
-                    "stop_sequence": int(db_dep["nOrder"]),
-                })
-
-        buff.close()
+        # Merge stops without location found by the parser
+        self.stops.invalid.update(db.invalid_stops)
+        self.stops.used_missing.update(db.used_missing_stops)
 
     def export_times(self):
         for trip in self.trips.values():
-            times = sorted(trip.pop("_times"), key=lambda i: i["stop_sequence"])
+            times = sorted(trip.pop("_times"))
 
             # Ignore empty trips
             if len(times) < 2:
                 continue
 
+            # Ignore trips whose service never operates in this file's date range
+            if trip["service_id"] not in self.services_active:
+                continue
+
             self.routes_used.add(trip["route_id"])
-            self.services_used.add(trip["service_id"])
 
             # Add id prefix
             trip_id = self.id_prefix + trip["trip_id"]
@@ -561,20 +661,18 @@ class RadomGtfs:
             trip["service_id"] = self.id_prefix + trip["service_id"]
 
             # Generate trip_headsign
-            last_stop_id = times[-1]["stop_id"]
-            last_stop_name = self.stops.data[last_stop_id]["stop_name"]
-            trip["trip_headsign"] = last_stop_name
+            trip["trip_headsign"] = self.stop_names[times[-1][1]]
 
             # Write to trips.txt
-            self.trips_wrtr.writerow(trip)
+            self.trips_wrtr.writerow((trip["route_id"], trip["service_id"], trip_id,
+                                      trip["trip_headsign"], trip["team_id"]))
 
             # Write to stop_times.txt
-            for idx, stop_time in enumerate(times):
-                stop_time["trip_id"] = trip_id
-                stop_time["stop_sequence"] = idx
-                self.stops.use_id(stop_time["stop_id"])
-
-                self.times_wrtr.writerow(stop_time)
+            self.stops.use_ids(stop_id for _, stop_id, _ in times)
+            self.times_wrtr.writerows(
+                (trip_id, time, time, stop_id, idx)
+                for idx, (_, stop_id, time) in enumerate(times)
+            )
 
     def export_dates(self):
         if not self.services_used.issubset(KNOWN_SERVICES):
@@ -585,30 +683,15 @@ class RadomGtfs:
             warn(f"databse {self.mdb_file!r} is not using major services "
                  f"(Powszedni, Sobota, Niedziela), only {self.services_used}")
 
-        current_day = self.start_date
-
-        while current_day <= self.end_date:
-            date_str = current_day.strftime("%Y%m%d")
-
-            # Holidays & Sundays
-            if current_day.weekday() == 6 or self.cal_exceptions.get(current_day) == "holiday":
-
-                if "NIEDZIELA" in self.services_used:
-                    self.dates_wrtr.writerow([self.id_prefix + "NIEDZIELA", date_str, 1])
+        start_idx = (self.start_date - self.calendar_start).days
+        end_idx = (self.end_date - self.calendar_start).days + 1
 
-            # Saturdays
-            elif current_day.weekday() == 5:
-
-                if "SOBOTA" in self.services_used:
-                    self.dates_wrtr.writerow([self.id_prefix + "SOBOTA", date_str, 1])
-
-            # Workdays
-            else:
+        days = [i for i in self.calendar[start_idx:end_idx] if i[1] in self.services_used]
+        self.services_active = {i[1] for i in days}
 
-                if "POWSZEDNI" in self.services_used:
-                    self.dates_wrtr.writerow([self.id_prefix + "POWSZEDNI", date_str, 1])
-
-            current_day += timedelta(days=1)
+        self.dates_wrtr.writerows(
+            (self.id_prefix + service_id, date_str, 1) for date_str, service_id in days
+        )
 
     # Main Function
 
@@ -634,40 +717,39 @@ class RadomGtfs:
 
         print("\033[1A\033[K" "Loading stops")
         self.stops.read_data_mybus()
+        self.stop_names = {k: v["stop_name"] for k, v in self.stops.data.items()}
+
+        print("\033[1A\033[K" "Resolving calendar")
+        self.map_calendar(min((i["start"] for i in files), default=date.today()),
+                          max((i["end"] for i in files), default=date.today()))
 
         print("\033[1A\033[K" "Opening trips/stop_times/calendar_dates")
         self.open_files()
 
         print("")
 
-        for file_info in files:
-            print("\033[2A\033[K" f"Parsing {file_info['path']}")
-            print("\033[K" "Resetting file data")
-            self.new_file(
-                file_name=file_info["path"], id_prefix=file_info["version"] + ":",
-                start_date=file_info["start"], end_date=file_info["end"],
-            )
-
-            print("\033[1A\033[K" "Loading table tStakes (stops)")
-            self.stops.read_table(self.mdb_file)
-
-            print("\033[1A\033[K" "Loading table tDirs (patterns)")
-            self.map_patterns()
+        # Databases are independent of each other, so they are parsed in parallel;
+        # results are still exported in order, as they share the output files.
+        with ProcessPoolExecutor() as executor:
+            parsed = executor.map(DatabaseParser.parse, [i["path"] for i in files],
+                                  repeat(set(self.stops.data)))
 
-            print("\033[1A\033[K" "Loading table tDayTypes (services)")
-            self.map_services()
+            print("\033[2A\033[K" "Parsing databases")
+            print("\033[K" "Waiting for the first database")
 
-            print("\033[1A\033[K" "Loading table tDepts (trips)")
-            self.load_trips()
+            for file_info, db in zip(files, parsed):
+                print("\033[2A\033[K" f"Exporting {file_info['path']}")
+                print("\033[K" "Merging file data")
+                self.new_file(
+                    db=db, id_prefix=file_info["version"] + ":",
+                    start_date=file_info["start"], end_date=file_info["end"],
+                )
 
-            print("\033[1A\033[K" "Loading table tPassages (stop_times)")
-            self.load_times()
+                print("\033[1A\033[K" "Exporting calendar_dates")
+                self.export_dates()
 
-            print("\033[1A\033[K" "Exporting trips & stop_times")
-            self.export_times()
-
-            print("\033[1A\033[K" "Exporting calendar_dates")
-            self.export_dates()
+                print("\033[1A\033[K" "Exporting trips & stop_times")
+                self.export_times()
 
         print("\033[2A\033[K" "Closing trip/stop_times/calendar_dates")
         print("\033[K", end="")
@@ -679,9 +761,6 @@ class RadomGtfs:
         print("\033[1A\033[K" "Exporting routes")
         self.routes()
 
-        print("\033[1A\033[K" "Validating used services")
-        self.verify_services()
-
         print("\033[1A\033[K" "Saving static files")
         self.static_files(feed_version, data_update, fp_name, fp_url)
 